@@ -41,7 +41,7 @@ setup(
     packages=find_packages("."),
     # package_dir = {"": "."},
     zip_safe=False,
-    install_requires=["asyncpg>=0.21.0"],
+    install_requires=["asyncpg>=0.25.0"],
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
         "Intended Audience :: Developers",
@@ -1,7 +1,15 @@
+import sys
+from copy import copy
+from time import perf_counter
 from dataclasses import make_dataclass
+from functools import lru_cache
 from enum import Enum
 
-from sqlblock.sqltext import SQLText
+import asyncpg
+
+from sqlblock.sqltext import SQLText, is_template
+
+from ._stmtcache import STALE_STATEMENT_ERRORS
 
 
 class BlockState(Enum):
@@ -11,34 +19,155 @@ class BlockState(Enum):
 
 
 def make_record_type(stmt):
-    return make_dataclass("Rec", [a.name for a in stmt.get_attributes()])
+    """Get the record type of the statement's result shape."""
+    shape = tuple((a.name, a.type.oid) for a in stmt.get_attributes())
+    return _record_type(shape)
+
+
+@lru_cache(maxsize=1024)
+def _record_type(shape):
+    names = tuple(name for name, _ in shape)
+    return make_dataclass("Rec", names, namespace={'__slots__': names})
+
+
+class Record(asyncpg.Record):
+    """The asyncpg record whose columns are also accessible as attributes.
+
+    In raw mode rows are yielded as these records without being converted.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
 
 
 class SQLBlock:
     __slots__ = ('_conn', '_sqltext', '_cursor', '_row_type',
-                 '_state', '_autocommit', '_parent', '_statment')
+                 '_state', '_autocommit', '_parent', '_statment',
+                 '_raw', '_stmt_raw', '_stmt_prefetch', '_stmt_cache',
+                 '_instrument', '_name', '_render_time', '_cache_puts')
 
-    def __init__(self, conn, autocommit=False, parent=None):
+    def __init__(self, conn, autocommit=False, parent=None, raw=False,
+                 stmt_cache=None, instrument=None, name=None):
         self._conn = conn
         self._autocommit = autocommit
         self._parent = parent
+        self._raw = raw
+        self._stmt_cache = stmt_cache
+        self._instrument = instrument
+        self._name = name
+        self._render_time = 0.0
+        self._cache_puts = None  # the result cache puts until committed
 
         self._cursor = None
         self._row_type = None
         self._sqltext = SQLText()
         self._state = BlockState.PENDING
         self._statment = None
+        self._stmt_raw = None
+        self._stmt_prefetch = None
 
     def join(self, sqltext, vars=None):
         if self._state != BlockState.PENDING:
             self._sqltext.clear()  # next a new SQL statement
             self._state = BlockState.PENDING
             self._statment = None
+            self._stmt_raw = None
+            self._stmt_prefetch = None
 
         self._sqltext._join(sqltext, vars=vars)
 
         return self
 
+    def raw(self, raw=True):
+        """Set whether the rows of the current statement are yielded as
+        :class:`Record` instances without conversion.
+        """
+        self._stmt_raw = raw
+        return self
+
+    def prefetch(self, prefetch):
+        """Set the number of rows the cursor of the current statement reads
+        ahead in each round trip.
+        """
+        self._stmt_prefetch = prefetch
+        return self
+
+    def _is_raw(self):
+        if self._stmt_raw is None:
+            return self._raw
+        return self._stmt_raw
+
+    async def _prepare(self, sql_stmt):
+        record_class = Record if self._is_raw() else None
+
+        if self._stmt_cache is not None:
+            return await self._stmt_cache.prepare(sql_stmt, record_class)
+
+        return await self._conn.prepare(sql_stmt, record_class=record_class)
+
+    def _make_row_type(self, stmt):
+        if self._is_raw():
+            return None
+
+        if self._stmt_cache is not None:
+            return self._stmt_cache.record_type(stmt, make_record_type)
+
+        return make_record_type(stmt)
+
+    def _render(self, params, sqltext=None):
+        if sqltext is None:
+            sqltext = self._sqltext
+
+        if self._instrument is None:
+            return sqltext.get_statment(params=params)
+
+        started_at = perf_counter()
+        statement = sqltext.get_statment(params=params)
+        self._render_time = perf_counter() - started_at
+
+        return statement
+
+    async def _execute(self, sql_stmt, execute, count_rows=None):
+        """Prepare the statement and return it with ``await execute(stmt)``.
+
+        A cached statement gone stale after schema changes is dropped from
+        the cache, and prepared again if it is not in a transaction.
+        """
+        instrument = self._instrument
+        if instrument is not None:
+            started_at = perf_counter()
+
+        stmt = await self._prepare(sql_stmt)
+        if instrument is not None:
+            prepared_at = perf_counter()
+
+        try:
+            result = await execute(stmt)
+        except STALE_STATEMENT_ERRORS:
+            if self._stmt_cache is None:
+                raise
+
+            self._stmt_cache.invalidate(sql_stmt)
+            if self._conn.is_in_transaction():
+                raise  # the transaction has been aborted
+
+            stmt = await self._prepare(sql_stmt)
+            result = await execute(stmt)
+
+        if instrument is not None:
+            executed_at = perf_counter()
+            render_time, self._render_time = self._render_time, 0.0
+            instrument.observe(
+                sql_stmt, self._name, render_time,
+                prepared_at - started_at, executed_at - prepared_at,
+                None if count_rows is None else count_rows(result))
+
+        return stmt, result
+
     async def fetch_first(self, **params):
         """Execute the statement and return the first record.
 
@@ -46,41 +175,226 @@ class SQLBlock:
         :return: The first row as a :class:`Rec` instance.
         """
 
-        sql_stmt, sql_vals = self._sqltext.get_statment(params=params)
+        sql_stmt, sql_vals = self._render(params)
         if not sql_stmt:
             return
 
-        stmt = await self._conn.prepare(sql_stmt)
-        record = await stmt.fetchrow(*sql_vals)
+        stmt, record = await self._execute(
+            sql_stmt, lambda stmt: stmt.fetchrow(*sql_vals), _count_row)
         self._state = BlockState.EXHAUSTED
 
         if record is not None:
-            record_type = make_record_type(stmt)
-            return record_type(**record)
+            row_type = self._make_row_type(stmt)
+            if row_type is None:
+                return record
 
-    async def fetch(self, **params):
+            return row_type(**record)
+
+    async def fetch_val(self, column=0, **params):
+        """Execute the statement and return a value of the first record.
+
+        :param column: The name or index of the column.
+        :param params: Query arguments
+        :return: The value, or None if there is no record.
+        """
+
+        sql_stmt, sql_vals = self._render(params)
+        if not sql_stmt:
+            return
 
-        sql_stmt, sql_vals = self._sqltext.get_statment(params=params)
+        _, value = await self._execute(
+            sql_stmt, lambda stmt: stmt.fetchval(*sql_vals, column=column),
+            _count_row)
+        self._state = BlockState.EXHAUSTED
+
+        return value
+
+    async def fetch_cached(self, cache, ttl=None, tags=(), **params):
+        """Return the rows of the statement from the result cache, or execute
+        the statement and cache its rows.
+        """
+        sql_stmt, sql_vals = self._render(params)
         if not sql_stmt:
             return
 
-        conn = self._conn
-        stmt = await conn.prepare(sql_stmt)
+        self._state = BlockState.EXHAUSTED
+
+        raw = self._is_raw()
+        key = cache.make_key(sql_stmt, sql_vals, raw)
+        if key is not None:
+            rows = cache.get(key)
+            if rows is not None:
+                self._render_time = 0.0  # no statement executed to report
+                return _copy_rows(rows, raw)
+
+        stmt, records = await self._execute(
+            sql_stmt, lambda stmt: stmt.fetch(*sql_vals), len)
+        rows = _make_rows(self._make_row_type(stmt), records)
+
+        if key is not None:
+            put = (cache, key, _copy_rows(rows, raw), ttl, tags)
+            if self._conn.is_in_transaction():
+                # the rows may be written by the transaction not committed
+                if self._cache_puts is None:
+                    self._cache_puts = []
+                self._cache_puts.append(put)
+            else:
+                cache.put(*put[1:])
+
+        return list(rows)
+
+    def _end_cache_puts(self, keep):
+        """Hand over the deferred cache puts to the outer block if still in
+        its transaction, or put them into the caches after committed. They
+        are dropped if not *keep* as the transaction is rolled back.
+        """
+        puts, self._cache_puts = self._cache_puts, None
+        if not puts or not keep:
+            return
+
+        if self._conn.is_in_transaction():
+            parent = self._parent
+            if parent is not None:
+                if parent._cache_puts is None:
+                    parent._cache_puts = []
+                parent._cache_puts += puts
+            return
+
+        for cache, key, rows, ttl, tags in puts:
+            cache.put(key, rows, ttl, tags)
+
+    def _discard_cache_puts(self, tags):
+        """ drop the deferred cache puts with any of the tags """
+        tags = set(tags)
+        block = self
+        while block is not None:
+            if block._cache_puts:
+                block._cache_puts = [put for put in block._cache_puts
+                                     if tags.isdisjoint(put[4])]
+            block = block._parent
+
+    async def fetch(self, **params):
+
+        sql_stmt, sql_vals = self._render(params)
+        if not sql_stmt:
+            return
 
         if self._autocommit:
             # cursor cannot be created outside of a transaction
-            records = await stmt.fetch(*sql_vals)
+            stmt, records = await self._execute(
+                sql_stmt, lambda stmt: stmt.fetch(*sql_vals), len)
             self._cursor = _IteratoAsyncrWrapper(records.__iter__())
         else:
-            self._cursor = await _fetch_cursor(stmt, sql_vals)
+            prefetch = self._stmt_prefetch
+            stmt, self._cursor = await self._execute(
+                sql_stmt, lambda stmt: _fetch_cursor(stmt, sql_vals, prefetch))
 
         self._statment = stmt
-        self._row_type = make_record_type(stmt)
+        self._row_type = self._make_row_type(stmt)
 
         self._state = BlockState.EXECUTED
 
         return self
 
+    async def batches(self, size=100, **params):
+        """Execute the statement and yield its rows in lists of *size*.
+
+        Each batch is read from the server-side cursor in one round trip.
+        """
+        if size < 1:
+            raise ValueError(f"size must be positive: {size}")
+
+        sql_stmt, sql_vals = self._render(params)
+        if not sql_stmt:
+            return
+
+        if self._autocommit:
+            # cursor cannot be created outside of a transaction
+            stmt, records = await self._execute(
+                sql_stmt, lambda stmt: stmt.fetch(*sql_vals), len)
+        else:
+            stmt, cursor = await self._execute(
+                sql_stmt, lambda stmt: stmt.cursor(*sql_vals))
+
+        self._statment = stmt
+        self._state = BlockState.EXECUTED
+
+        row_type = self._make_row_type(stmt)
+
+        if self._autocommit:
+            for i in range(0, len(records), size):
+                yield _make_rows(row_type, records[i:i + size])
+        else:
+            while True:
+                records = await cursor.fetch(size)
+                if records:
+                    yield _make_rows(row_type, records)
+                if len(records) < size:
+                    break
+
+        self._state = BlockState.EXHAUSTED
+
+    def pipeline(self):
+        """Create a pipeline to collect statements executed together."""
+        return SQLPipeline(self)
+
+    async def executemany(self, many_params, *, chunk_size=1000):
+        """Execute the statement for each mapping of params in chunks.
+
+        :param many_params: An iterable of mappings of query arguments.
+        :param chunk_size: The maximum number of argument sets sent to the
+            server in one batch.
+        :return: The number of argument sets executed.
+        """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be positive: {chunk_size}")
+
+        count = 0
+        chunk = []
+        for params in many_params:
+            chunk.append(params)
+            if len(chunk) >= chunk_size:
+                count += await self._executemany(chunk)
+                chunk = []
+
+        if chunk:
+            count += await self._executemany(chunk)
+
+        self._state = BlockState.EXHAUSTED
+
+        return count
+
+    async def _executemany(self, many_params):
+        sql_stmt, many_vals = self._sqltext.get_statment(
+            many_params=many_params)
+        if not sql_stmt:
+            return 0
+
+        await self._conn.executemany(sql_stmt, many_vals)
+        return len(many_vals)
+
+    async def copy_from_query(self, output, *, params=None, timeout=None,
+                              **copy_options):
+        """Copy the result of the statement to *output* with COPY TO.
+
+        :param output: A path-like object, a file-like object or a coroutine
+            function that takes chunks of the data.
+        :param params: Query arguments.
+        :param copy_options: The options of COPY like format and header.
+        :return: The status string of the COPY command.
+        """
+        sql_stmt, sql_vals = self._render(params)
+        self._render_time = 0.0  # not reported by the instrument
+        if not sql_stmt:
+            return
+
+        status = await self._conn.copy_from_query(
+            sql_stmt, *sql_vals, output=output, timeout=timeout,
+            **copy_options)
+        self._state = BlockState.EXHAUSTED
+
+        return status
+
     def get_statusmsg(self):
         return self._statment.get_statusmsg()
 
@@ -98,7 +412,10 @@ class SQLBlock:
 
         try:
             record = await self._cursor.__anext__()
-            return self._row_type(**record)
+            row_type = self._row_type
+            if row_type is None:
+                return record
+            return row_type(**record)
         except StopAsyncIteration:
             self._state = BlockState.EXHAUSTED
             self._cursor = None
@@ -106,8 +423,192 @@ class SQLBlock:
             raise
 
 
-async def _fetch_cursor(stmt, sql_vals):
-    _iter = stmt.cursor(*sql_vals).__aiter__()
+def _count_row(record):
+    return 0 if record is None else 1
+
+
+def _count_array_rows(arrays):
+    return sum(len(rows) for rows in arrays)
+
+
+def _copy_rows(rows, raw):
+    """ copy the mutable rows shared with the result cache """
+    if raw:
+        return list(rows)  # the records are immutable
+    return [copy(row) for row in rows]
+
+
+def _make_rows(row_type, records):
+    if row_type is None:
+        return records
+    return [row_type(**record) for record in records]
+
+
+class SQLPipeline:
+    """Independent statements sent to the server together in one round trip.
+
+    The statements are combined into one query which returns an array of
+    rows per statement, so each statement must be a query like SELECT,
+    VALUES or WITH ... SELECT without a trailing semicolon.
+
+    Columns nested in the arrays are decoded in binary format. If a column
+    has a codec that can only decode text, or there is no statement cache to
+    know the columns, the statements are executed one by one. In raw mode
+    the rows decoded from the arrays are :class:`ArrayRecord` instances.
+    """
+    __slots__ = ('_block', '_sqltexts')
+
+    def __init__(self, block):
+        self._block = block
+        self._sqltexts = []
+
+    def __lshift__(self, sqltext):
+        if isinstance(sqltext, str):
+            sqltext = SQLText()._join(sqltext, vars=sys._getframe(1).f_locals)
+        elif is_template(sqltext):
+            sqltext = SQLText()._join(sqltext, vars=None)
+        elif not isinstance(sqltext, SQLText):
+            raise TypeError(type(sqltext))
+
+        self._sqltexts.append(sqltext)
+        return self
+
+    def __len__(self):
+        return len(self._sqltexts)
+
+    def __await__(self):
+        return self.execute().__await__()
+
+    async def execute(self, **params):
+        """Execute the statements and return a list of rows per statement."""
+        sqltexts = self._sqltexts
+        if not sqltexts:
+            return []
+
+        block = self._block
+        cache = block._stmt_cache
+        if cache is None:
+            # Preparing the statements to know their columns would cost one
+            # more round trip than executing them one by one.
+            return await self._execute_sequentially(params)
+
+        pieces = ["SELECT "]
+        for i, sqltext in enumerate(sqltexts):
+            if i > 0:
+                pieces.append(", ")
+            pieces += ["ARRAY(SELECT ROW(t.*) FROM (", sqltext, ") AS t)"]
+
+        combined = SQLText()._join(*pieces, vars={})
+        combined_stmt, _ = combined._render()
+        if combined_stmt in cache.sequential_pipelines:
+            return await self._execute_sequentially(params)
+
+        # Prepare each statement through the statement cache to know its
+        # columns, which also introspects the codecs of the column types.
+        stmts = []
+        for sqltext in sqltexts:
+            sql_stmt, _ = sqltext.get_statment(params=params)
+            stmts.append(await block._prepare(sql_stmt))
+
+        text_types = block._conn._sqlblock_text_types
+        if text_types and any(_has_text_codec(stmt, text_types)
+                              for stmt in stmts):
+            cache.add_sequential_pipeline(combined_stmt)
+            return await self._execute_sequentially(params)
+
+        sql_stmt, sql_vals = block._render(params, combined)
+        try:
+            _, arrays = await block._execute(
+                sql_stmt, lambda stmt: stmt.fetchrow(*sql_vals),
+                _count_array_rows)
+        except asyncpg.exceptions.InternalClientError:
+            # no binary decoder of a column type nested in the arrays
+            cache.add_sequential_pipeline(combined_stmt)
+            return await self._execute_sequentially(params)
+
+        raw = block._is_raw()
+        results = []
+        for stmt, rows in zip(stmts, arrays):
+            if raw:
+                row_type = _array_record_type(
+                    tuple(a.name for a in stmt.get_attributes()))
+                results.append([row_type(row) for row in rows])
+            else:
+                row_type = block._make_row_type(stmt)
+                results.append([row_type(*row) for row in rows])
+
+        return results
+
+    async def _execute_sequentially(self, params):
+        block = self._block
+        results = []
+        for sqltext in self._sqltexts:
+            sql_stmt, sql_vals = block._render(params, sqltext)
+            stmt, records = await block._execute(
+                sql_stmt, lambda stmt: stmt.fetch(*sql_vals), len)
+            results.append(_make_rows(block._make_row_type(stmt), records))
+
+        return results
+
+
+def _has_text_codec(stmt, text_types):
+    """ whether a column type or its element type has a text-only codec """
+    for attr in stmt.get_attributes():
+        typ = attr.type
+        name = typ.name[:-2] if typ.kind == 'array' else typ.name
+        if (typ.schema, name) in text_types:
+            return True
+
+    return False
+
+
+class ArrayRecord(tuple):
+    """The row decoded from the array of a pipeline in raw mode, whose
+    columns are accessible by index, name and attribute as :class:`Record`.
+    """
+    __slots__ = ()
+
+    _index = {}  # the column name -> position
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def keys(self):
+        return iter(self._index)
+
+    def values(self):
+        return iter(self)
+
+    def items(self):
+        return zip(self._index, self)
+
+    def __repr__(self):
+        fields = ' '.join(f"{k}={v!r}" for k, v in self.items())
+        return f"<Record {fields}>"
+
+
+@lru_cache(maxsize=1024)
+def _array_record_type(names):
+    index = {name: i for i, name in enumerate(names)}
+    return type("Record", (ArrayRecord,), {'__slots__': (), '_index': index})
+
+
+async def _fetch_cursor(stmt, sql_vals, prefetch=None):
+    _iter = stmt.cursor(*sql_vals, prefetch=prefetch).__aiter__()
     try:
         this_one = await _iter.__anext__()
         return _ThisOneAsyncIterator(_iter, this_one)
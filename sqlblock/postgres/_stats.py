@@ -0,0 +1,73 @@
+from bisect import bisect_left
+
+
+class Histogram:
+    """The counts of observed durations in seconds by bucket.
+
+    The count of each bucket is of the durations not greater than its upper
+    bound and greater than the bound of the previous one, the last bucket
+    counts the durations beyond all bounds.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    DEFAULT_BOUNDS = (0.0005, 0.001, 0.005, 0.01, 0.05,
+                      0.1, 0.5, 1.0, 5.0, 10.0)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        buckets = {str(bound): n for bound, n in zip(self.bounds, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+
+        return dict(count=self.count, sum=self.sum, max=self.max,
+                    buckets=buckets)
+
+
+class PoolStats:
+    """The counters of a connection pool, cheap enough to be always on.
+
+    ``acquire_time`` is the histogram of the time waited for connections and
+    ``hold_time`` of the time they were held until released.
+    """
+    __slots__ = ('acquire_time', 'hold_time', 'acquired', 'failed',
+                 'in_use', 'waiting', 'max_waiting')
+
+    def __init__(self):
+        self.acquire_time = Histogram()
+        self.hold_time = Histogram()
+        self.acquired = 0
+        self.failed = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.max_waiting = 0
+
+    def as_dict(self, pool=None):
+        stats = dict(
+            acquired=self.acquired,
+            failed=self.failed,
+            in_use=self.in_use,
+            waiting=self.waiting,
+            max_waiting=self.max_waiting,
+            acquire_time=self.acquire_time.as_dict(),
+            hold_time=self.hold_time.as_dict(),
+        )
+
+        if pool is not None:
+            size = pool.get_size()
+            stats['size'] = size
+            stats['idle'] = max(size - self.in_use, 0)
+            stats['max_size'] = pool.get_max_size()
+
+        return stats
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+
+import asyncpg.exceptions
+from asyncpg.prepared_stmt import PreparedStatement
+
+
+# The errors raised when the prepared statement is stale after schema changes
+STALE_STATEMENT_ERRORS = (
+    asyncpg.exceptions.InvalidCachedStatementError,
+    asyncpg.exceptions.OutdatedSchemaCacheError,
+)
+
+
+class StatementCacheStats:
+    """The counters shared by the statement caches of all connections."""
+    __slots__ = ('hits', 'misses', 'evictions', 'invalidations')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class StatementCache:
+    """The LRU cache of prepared statements of one connection.
+
+    The statements are keyed by their rendered SQL text, so the statement
+    is parsed and planned by the server once per connection per template.
+    """
+    __slots__ = ('_conn', '_stmts', '_record_types', 'maxsize', 'stats',
+                 'sequential_pipelines')
+
+    def __init__(self, conn, maxsize, stats):
+        self._conn = conn
+        self._stmts = OrderedDict()
+        self._record_types = {}
+        self.maxsize = maxsize
+        self.stats = stats
+
+        # the combined queries of pipelines executed one by one instead
+        self.sequential_pipelines = OrderedDict()
+
+    async def prepare(self, query, record_class=None):
+        key = (query, record_class)
+
+        stmt = self._stmts.get(key)
+        if stmt is not None:
+            if not stmt._state.closed:
+                self._stmts.move_to_end(key)
+                self.stats.hits += 1
+
+                conn = self._conn
+                if stmt._con_release_ctr != conn._pool_release_ctr:
+                    # The statement object is only valid while the connection
+                    # is acquired, wrap the server-side statement again.
+                    stmt = PreparedStatement(conn, query, stmt._state)
+                    self._stmts[key] = stmt
+
+                return stmt
+
+            del self._stmts[key]
+
+        self.stats.misses += 1
+        stmt = await self._conn.prepare(query, record_class=record_class)
+
+        self._stmts[key] = stmt
+        while len(self._stmts) > self.maxsize:
+            (evicted_query, _), _ = self._stmts.popitem(last=False)
+            self._record_types.pop(evicted_query, None)
+            self.stats.evictions += 1
+
+        return stmt
+
+    def record_type(self, stmt, make_record_type):
+        """Get the record type of the statement made once per query."""
+        query = stmt.get_query()
+        record_type = self._record_types.get(query)
+        if record_type is None:
+            record_type = make_record_type(stmt)
+            self._record_types[query] = record_type
+
+        return record_type
+
+    def invalidate(self, query=None):
+        """Drop the statements of the query, or all if query is None."""
+        if query is None:
+            keys = list(self._stmts)
+        else:
+            keys = [key for key in self._stmts if key[0] == query]
+
+        for key in keys:
+            del self._stmts[key]
+            self._record_types.pop(key[0], None)
+            self.stats.invalidations += 1
+
+    def add_sequential_pipeline(self, query):
+        """Remember the pipeline whose rows can not be decoded in arrays."""
+        self.sequential_pipelines[query] = True
+        while len(self.sequential_pipelines) > self.maxsize:
+            self.sequential_pipelines.popitem(last=False)
+
+    def __len__(self):
+        return len(self._stmts)
@@ -0,0 +1,83 @@
+import random
+import logging
+from zlib import crc32
+
+_logger = logging.getLogger("sqlblock")
+
+
+class StatementEvent:
+    """The timing of a statement executed in a SQL block.
+
+    The times are in seconds. *rows* is None if the rows are read through a
+    cursor after the statement is executed.
+    """
+    __slots__ = ('sql', 'func', 'render_time', 'prepare_time',
+                 'execute_time', 'rows', 'slow')
+
+    def __init__(self, sql, func, render_time, prepare_time, execute_time,
+                 rows, slow):
+        self.sql = sql
+        self.func = func
+        self.render_time = render_time
+        self.prepare_time = prepare_time
+        self.execute_time = execute_time
+        self.rows = rows
+        self.slow = slow
+
+    @property
+    def template_id(self):
+        """ the stable id of the statement text regardless of its values """
+        return f"{crc32(self.sql.encode()):08x}"
+
+    @property
+    def total_time(self):
+        return self.render_time + self.prepare_time + self.execute_time
+
+    def as_dict(self):
+        d = {name: getattr(self, name) for name in self.__slots__}
+        d['template_id'] = self.template_id
+        return d
+
+    def __repr__(self):
+        return (f"StatementEvent(template_id={self.template_id}, "
+                f"func={self.func}, total_time={self.total_time:.6f}, "
+                f"rows={self.rows}, slow={self.slow})")
+
+
+class StatementInstrument:
+    """Report the timing of statements executed in SQL blocks.
+
+    The statements slower than *slow_threshold* seconds are always reported
+    and logged as warnings, the others are reported with the probability of
+    *sample_rate*. Subclasses may override :meth:`report` instead of giving
+    the callback.
+
+    :param callback: The function called with each :class:`StatementEvent`.
+    """
+
+    def __init__(self, callback=None, *, slow_threshold=None, sample_rate=1.0):
+        self.callback = callback
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+
+    def observe(self, sql, func, render_time, prepare_time, execute_time,
+                rows):
+        total_time = render_time + prepare_time + execute_time
+
+        threshold = self.slow_threshold
+        slow = threshold is not None and total_time >= threshold
+        if not slow and (self.sample_rate < 1.0 and
+                         random.random() >= self.sample_rate):
+            return
+
+        event = StatementEvent(sql, func, render_time, prepare_time,
+                               execute_time, rows, slow)
+        if slow:
+            _logger.warning(f"slow statement in {func} took "
+                            f"{total_time:.3f}s: {sql}")
+
+        self.report(event)
+
+    def report(self, event):
+        if self.callback is not None:
+            self.callback(event)
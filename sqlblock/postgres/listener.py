@@ -0,0 +1,313 @@
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+
+_logger = logging.getLogger("sqlblock")
+
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+
+_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+class ClosedSubscriptionException(Exception):
+    pass
+
+
+class Subscription:
+    """The bounded queue of notification payloads of one subscriber.
+
+    When the queue is full, the policy ``drop_oldest`` drops the oldest
+    pending payload and ``drop_newest`` drops the arrived one. The policy
+    ``coalesce`` ignores a payload equal to a pending one, and drops the
+    oldest if the queue is still full.
+    """
+    __slots__ = ('_listener', 'channel', 'maxsize', 'policy', '_pending',
+                 '_pending_set', '_ready', '_closed',
+                 'received', 'dropped', 'max_lag', 'last_lag')
+
+    def __init__(self, listener, channel, maxsize, policy):
+        if policy not in _POLICIES:
+            raise ValueError(f"Unknown policy: '{policy}'")
+
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be positive: {maxsize}")
+
+        self._listener = listener
+        self.channel = channel
+        self.maxsize = maxsize
+        self.policy = policy
+
+        self._pending = deque()  # (payload, received_at)
+        self._pending_set = set() if policy == COALESCE else None
+        self._ready = asyncio.Event()
+        self._closed = False
+
+        self.received = 0
+        self.dropped = 0
+        self.max_lag = 0.0  # seconds from received to consumed
+        self.last_lag = 0.0
+
+    def _put(self, payload, received_at):
+        self.received += 1
+
+        pending = self._pending
+        if self._pending_set is not None:
+            if payload in self._pending_set:
+                self.dropped += 1
+                return
+            self._pending_set.add(payload)
+
+        if len(pending) >= self.maxsize:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+
+            dropped, _ = pending.popleft()
+            if self._pending_set is not None:
+                self._pending_set.discard(dropped)
+
+        pending.append((payload, received_at))
+        self._ready.set()
+
+    async def get(self):
+        """Wait and return the next payload.
+
+        :raise ClosedSubscriptionException: if it has been unsubscribed.
+        """
+        while not self._pending:
+            if self._closed:
+                raise ClosedSubscriptionException(
+                    f"The subscription of '{self.channel}' is closed")
+            self._ready.clear()
+            await self._ready.wait()
+
+        payload, received_at = self._pending.popleft()
+        if self._pending_set is not None:
+            self._pending_set.discard(payload)
+
+        lag = monotonic() - received_at
+        self.last_lag = lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+        return payload
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except ClosedSubscriptionException:
+            raise StopAsyncIteration
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Unsubscribe, the pending payloads can still be consumed."""
+        await self._listener.unsubscribe(self)
+
+    def _close(self):
+        self._closed = True
+        self._ready.set()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def stats(self):
+        return dict(channel=self.channel, policy=self.policy,
+                    maxsize=self.maxsize, pending=len(self._pending),
+                    received=self.received, dropped=self.dropped,
+                    max_lag=self.max_lag, last_lag=self.last_lag)
+
+
+class Listener:
+    """Listen for the notifications of channels on a dedicated connection
+    and fan them out to the subscribers.
+
+    The connection is acquired from the pool when the first channel is
+    subscribed. If it is lost, a new one is acquired after *reconnect_delay*
+    seconds and all channels are listened on it again.
+    """
+
+    def __init__(self, pool, *, reconnect_delay=1.0):
+        self._pool = pool
+        self._conn = None
+        self._subscribers = {}  # channel -> list of Subscription
+        self._defaults = {}  # channel -> Subscription used by get()
+
+        self._lock = asyncio.Lock()
+        self._reconnect_delay = reconnect_delay
+        self._reconnect_task = None
+        self._closed = False
+
+        self.reconnects = 0
+
+        def _callback(conn, pid, channel, payload):
+            received_at = monotonic()
+            for subscription in self._subscribers.get(channel, ()):
+                subscription._put(payload, received_at)
+
+        self._callback = _callback
+
+        def _on_terminated(conn):
+            if self._closed or conn is not self._conn:
+                return
+
+            _logger.warning("lost the connection of listener, reconnecting")
+            self._conn = None
+            self._reconnect_task = asyncio.ensure_future(
+                self._reconnect(conn))
+
+        self._on_terminated = _on_terminated
+
+    async def subscribe(self, channel, *, maxsize=1000, policy=DROP_OLDEST):
+        """Subscribe the channel with a queue of at most *maxsize* payloads.
+
+        ``async for payload in subscription`` iterates the payloads until it
+        is closed.
+        """
+        subscription = Subscription(self, channel, maxsize, policy)
+
+        async with self._lock:
+            if self._closed:
+                raise ValueError("The listener is closed")
+
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None:
+                subscribers = []
+                if self._conn is None and self._reconnect_task is None:
+                    await self._open()
+
+                if self._conn is not None:
+                    await self._conn.add_listener(channel, self._callback)
+
+                self._subscribers[channel] = subscribers
+
+            subscribers.append(subscription)
+
+        return subscription
+
+    async def unsubscribe(self, subscription):
+        subscription._close()
+
+        async with self._lock:
+            channel = subscription.channel
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None or subscription not in subscribers:
+                return
+
+            subscribers.remove(subscription)
+            if self._defaults.get(channel) is subscription:
+                del self._defaults[channel]
+
+            if not subscribers:
+                del self._subscribers[channel]
+                if self._conn is not None:
+                    await self._conn.remove_listener(channel, self._callback)
+
+    async def get(self, channel):
+        """Wait and return the next payload of the channel, shared by all
+        callers of the channel.
+        """
+        subscription = self._defaults.get(channel)
+        if subscription is None:
+            subscription = await self.subscribe(channel)
+            self._defaults[channel] = subscription
+
+        return await subscription.get()
+
+    async def register(self, channel):
+        """ register a channel to listen """
+
+        if channel in self._defaults:
+            raise ValueError(f"The channel has been registered: '{channel}'")
+
+        self._defaults[channel] = await self.subscribe(channel)
+
+    async def unregister(self, channel):
+        """ unregister a channel """
+
+        subscription = self._defaults.get(channel)
+        if subscription is not None:
+            await self.unsubscribe(subscription)
+
+    async def open(self):
+        async with self._lock:
+            if self._conn is None:
+                await self._open()
+
+    async def _open(self):
+        conn = await self._pool.acquire()
+        if conn is None:
+            raise ConnectionError("unavailable connection to listen")
+
+        conn.add_termination_listener(self._on_terminated)
+        self._conn = conn
+
+    async def _reconnect(self, lost_conn):
+        try:
+            await self._pool.release(lost_conn)
+        except Exception as exc:
+            _logger.debug(f"failed to release the lost connection: {exc}")
+
+        while not self._closed:
+            await asyncio.sleep(self._reconnect_delay)
+            try:
+                async with self._lock:
+                    await self._open()
+                    for channel in self._subscribers:
+                        await self._conn.add_listener(channel, self._callback)
+            except Exception as exc:
+                _logger.warning(f"failed to reconnect the listener: {exc}")
+                if self._conn is not None:
+                    conn, self._conn = self._conn, None
+                    await self._pool.release(conn)
+                continue
+
+            self.reconnects += 1
+            self._reconnect_task = None
+            return
+
+    async def close(self):
+        async with self._lock:
+            self._closed = True
+
+            if self._reconnect_task is not None:
+                self._reconnect_task.cancel()
+                self._reconnect_task = None
+
+            conn, self._conn = self._conn, None
+            for channel, subscribers in self._subscribers.items():
+                for subscription in subscribers:
+                    subscription._close()
+
+                if conn is not None and not conn.is_closed():
+                    await conn.remove_listener(channel, self._callback)
+
+            self._subscribers = {}
+            self._defaults = {}
+
+            if conn is not None:
+                conn.remove_termination_listener(self._on_terminated)
+                await self._pool.release(conn)
+
+    def stats(self):
+        """ the metrics of the subscriptions by channel """
+        return dict(
+            connected=self._conn is not None,
+            reconnects=self.reconnects,
+            channels={
+                channel: [s.stats() for s in subscribers]
+                for channel, subscribers in self._subscribers.items()
+            },
+        )
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+from sqlblock.utils import json_loads
+
+_logger = logging.getLogger("sqlblock")
+
+
+class ResultCache:
+    """The LRU cache of the rows of statements with TTL and tags.
+
+    The rows are keyed by the rendered SQL text and the bound values. The
+    cached entries are invalidated by tags, also in the other application
+    instances if *channel* is given, by the notifications on the channel.
+
+    :param maxsize: The maximum number of cached results.
+    :param ttl: The default seconds a result is kept.
+    :param channel: The channel of LISTEN/NOTIFY on which the invalidated
+        tags are published.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0, channel=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.channel = channel
+
+        self._entries = OrderedDict()  # key -> (expires_at, rows, tags)
+        self._tagged = {}  # tag -> set of keys
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(sql_stmt, sql_vals, raw=False):
+        """Return the key of the statement, or None if the values are not
+        hashable and the result cannot be cached.
+        """
+        key = (sql_stmt, tuple(sql_vals), raw)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, rows, _ = entry
+            if expires_at > monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return rows
+
+            self._remove(key)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, rows, ttl=None, tags=()):
+        if key in self._entries:
+            self._remove(key)
+
+        if ttl is None:
+            ttl = self.ttl
+
+        tags = frozenset(tags)
+        self._entries[key] = (monotonic() + ttl, rows, tags)
+        for tag in tags:
+            self._tagged.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def invalidate(self, *tags):
+        """Drop the cached results with any of the tags."""
+        for tag in tags:
+            for key in self._tagged.pop(tag, ()):
+                entry = self._entries.pop(key, None)
+                if entry is None:
+                    continue
+
+                for other_tag in entry[2]:
+                    if other_tag != tag:
+                        keys = self._tagged.get(other_tag)
+                        if keys is not None:
+                            keys.discard(key)
+                            if not keys:
+                                del self._tagged[other_tag]
+
+    def clear(self):
+        self._entries.clear()
+        self._tagged.clear()
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    maxsize=self.maxsize, currsize=len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def listen(self, listener):
+        """Invalidate the tags received on the channel until cancelled.
+
+        The payload of each notification is a JSON array of tags.
+        """
+        while True:
+            try:
+                subscription = await listener.subscribe(
+                    self.channel, maxsize=self.maxsize, policy='coalesce')
+                async with subscription:
+                    async for payload in subscription:
+                        try:
+                            self.invalidate(*json_loads(payload))
+                        except (ValueError, TypeError):
+                            _logger.warning(f"invalid tags of result cache "
+                                            f"on '{self.channel}': {payload}")
+                return  # the listener is closed
+
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _logger.exception(f"failed to listen the invalidations "
+                                  f"of result cache on '{self.channel}'")
+                await asyncio.sleep(1.0)
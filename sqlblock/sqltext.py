@@ -1,13 +1,23 @@
 import sys
 import string
+from keyword import iskeyword
+from operator import attrgetter
+from functools import lru_cache
+from collections import ChainMap
 from collections.abc import Sequence, Mapping
 
+try:
+    from string.templatelib import Template
+except ImportError:  # before Python 3.14
+    Template = None
+
 
 class SQLText:
-    __tuple__ = ('_segments',)
+    __slots__ = ('_segments', '_statement')
 
     def __init__(self):
         self._segments = []
+        self._statement = None  # the rendered text and placeholders
 
     def __bool__(self):
         return bool(self._segments)
@@ -15,32 +25,34 @@ class SQLText:
     def __iadd__(self, sqltext):
         if isinstance(sqltext, SQLText):
             self._segments += sqltext._segments
+            self._statement = None
             return self
 
         elif isinstance(sqltext, str):
             return self._join(sqltext, sep='', vars=sys._getframe(1).f_locals)
 
+        elif is_template(sqltext):
+            return self._join(sqltext, sep='', vars=_NO_VARS)
+
         else:
             raise TypeError(type(sqltext))
 
     def __add__(self, sqltext):
         if isinstance(sqltext, SQLText):
-            newone = SQLText()
-            newone._segments += self._segments
-            newone._segments += sqltext._segments
+            segments = sqltext._segments
 
         elif isinstance(sqltext, str):
             segments = _sqlstr_parse(sqltext, sys._getframe(1).f_locals)
 
-            newone = SQLText()
-            newone._segments += self._segments
-            newone._segments += segments
-            return newone
+        elif is_template(sqltext):
+            segments = _template_parse(sqltext)
 
         else:
             raise TypeError(type(sqltext))
 
-        return self
+        newone = SQLText()
+        newone._segments = self._segments + segments
+        return newone
 
     def __rshift__(self, sqlblock):
         if hasattr(sqlblock, '__lshift__'):
@@ -49,36 +61,24 @@ class SQLText:
 
         raise ValueError("SQL(' ') >> sqlblock")
 
-    def _join(self, *sqltexts, sep='', vars):
+    def _join(self, *sqltexts, sep='', vars, share=False):
         if not sqltexts:
             return
 
-        sql_text_iter = iter(sqltexts)
-        sqltext = next(sql_text_iter, None)
-
-        if isinstance(sqltext, str):
-            segments = _sqlstr_parse(sqltext, vars)
-        elif isinstance(sqltext, SQLText):
-            segments = [] + sqltext._segments
-        else:
-            raise TypeError()
-
-        if segments and self._segments:
-            self._segments.append(SQLSegment(sep, vars))
+        self._statement = None
 
-        self._segments += segments
-
-        for sqltext in sql_text_iter:
+        for sqltext in sqltexts:
             if isinstance(sqltext, str):
-                segments = _sqlstr_parse(sqltext, vars)
+                segments = _sqlstr_parse(sqltext, vars, share)
             elif isinstance(sqltext, SQLText):
-                segments = [] + sqltext._segments
+                segments = sqltext._segments
+            elif is_template(sqltext):
+                segments = _template_parse(sqltext, share)
             else:
                 raise TypeError()
 
-            # segments = qlstr_parse(sqlstr, frame)
-            if segments:
-                self._segments.append(SQLSegment(sep, vars))
+            if segments and self._segments:
+                self._segments.append(sep)
 
             self._segments += segments
 
@@ -86,21 +86,45 @@ class SQLText:
 
     def clear(self):
         self._segments = []
+        self._statement = None
+
+    def _render(self):
+        """Render the statement text in one pass and cache it with its
+        placeholders until the text is changed.
+
+        The repeated placeholders made with ``share=True`` of the same name
+        or attribute chain bound with the same value share one parameter.
+        """
+        statement = self._statement
+        if statement is None:
+            texts = []
+            placeholders = []
+            indexes = {}  # the key of a shareable placeholder -> $n
+            for seg in self._segments:
+                if seg.__class__ is str:
+                    texts.append(seg)
+                    continue
+
+                key = _shared_key(seg)
+                n = indexes.get(key) if key is not None else None
+                if n is None:
+                    placeholders.append(seg)
+                    n = len(placeholders)
+                    if key is not None:
+                        indexes[key] = n
+
+                if seg.spec == 'any':
+                    texts.append(f"= ANY(${n})")
+                else:
+                    texts.append(f"${n}")
+
+            statement = (''.join(texts), placeholders)
+            self._statement = statement
+
+        return statement
 
     def get_statment(self, *, params=None, many_params=None):
-        sql_text = ''
-
-        placeholders = []
-
-        var_counter = 0
-        for seg in self._segments:
-            if isinstance(seg, SQLSegment):
-                sql_text += seg.text
-
-            elif isinstance(seg, SQLPlaceholder):
-                placeholders.append(seg)
-                var_counter += 1
-                sql_text += f"${var_counter}"
+        sql_text, placeholders = self._render()
 
         if many_params is None:
             assert params is None or isinstance(params, Mapping)
@@ -121,89 +145,305 @@ class SQLText:
 
 def eval_param_vals(params, placeholders):
     sql_vals = []
-
     for seg in placeholders:
-        localvars = {}
-        localvars.update(seg.vars)
-        if params:
-            localvars.update(params)
-        
-        value = eval_expr(seg.field_name, localvars)
-        sql_vals += [value]
+        value = seg.value
+        if params and not seg.expr.names.isdisjoint(params):
+            # the given params override the variables captured in the context
+            value = seg.expr.evaluate(ChainMap(params, seg.vars))
+        elif value is _UNBOUND:
+            value = seg.expr.evaluate(seg.vars)  # raise the NameError
+
+        if seg.spec == 'any':
+            value = _array_value(value, seg)
+
+        sql_vals.append(value)
+
     return sql_vals
 
 
-class SQLSegmentBase:
-    def __init__(self, vars):
-        self.offset = (0, 0)  # lineno, charpos at line
-        self.vars = vars   # frame.f_lineno frame.f_code.co_filename
+def _shared_key(seg):
+    """The key of the placeholders evaluated to the same parameter, or None
+    if it is not shared.
 
+    A name or an attribute chain bound with the same value object always
+    evaluates to the same value, even if it is overridden by params. The
+    value of a template string is never evaluated again.
+    """
+    if not seg.shared:
+        return None
 
-class SQLSegment(SQLSegmentBase):
+    expr = seg.expr
+    if expr.__class__ is SQLExpr and expr._name is None:
+        return None
 
-    def __init__(self, text, vars):
-        super().__init__(vars)
-        self.text = text
+    return (expr.__class__, expr.expr, seg.spec, id(seg.value))
 
-        # compute the offset of this segment
-        lines = text.splitlines()
-        if lines:
-            offset_lineno = len(lines) - 1
-            offset_charpos = len(lines[offset_lineno])
 
-            self.offset = (offset_lineno, offset_charpos)
+def _array_value(value, seg):
+    """ the collection bound as one array parameter by {name:any} """
+    if isinstance(value, (list, tuple)):
+        return value
+
+    if isinstance(value, (str, bytes, Mapping)) or \
+            not hasattr(value, '__iter__'):
+        raise TypeError(f"expected a collection for '{{{seg.field_name}:any}}'"
+                        f", got {type(value).__name__}")
+    return list(value)
 
-    def __repr__(self):
-        return f"SQLSegment(text='{self.text}', offset={self.offset})"
 
+_UNBOUND = object()  # the value of placeholder bound by params at execution
 
-class SQLPlaceholder(SQLSegmentBase):
-    def __init__(self, field_name, value, vars):
-        super().__init__(vars)
+_NO_VARS = {}
+
+
+class SQLPlaceholder:
+    """A placeholder with its bound value and only the variables needed to
+    evaluate its expression again with the params at execution.
+
+    The literal text between placeholders is kept as plain str segments.
+    """
+    __slots__ = ('expr', 'value', 'vars', 'spec', 'shared')
+
+    def __init__(self, expr, value, vars, spec=None, shared=False):
+        self.expr = expr
         self.value = value
-        self.field_name = field_name
+        self.vars = vars
+        self.spec = spec  # 'any' renders '= ANY($n)' bound with an array
+        self.shared = shared  # may share the parameter with the same ones
+
+    @property
+    def field_name(self):
+        return self.expr.expr
 
     def __repr__(self):
-        return f"SQLPlaceholder(value='{self.value}', offset={self.offset})"
+        return f"SQLPlaceholder(expr={self.expr.expr!r}, value={self.value!r})"
 
 
 _formatter = string.Formatter()
 
 
-def _sqlstr_parse(sqlstr, vars):
-    vars = dict(vars)
+class SQLTemplate:
+    """The parsed layout of a SQL format string.
+
+    Each part is a tuple ``(text, expr, spec)`` where *text* is the
+    literal text before the placeholder whose compiled expression is *expr*,
+    which is None if there is no placeholder after the text, and *spec* is
+    its format spec or None. The names referenced by all expressions are in
+    *names*.
+
+    The only format spec is ``any``, ``{ids:any}`` renders ``= ANY($n)``
+    bound with the collection as one array, so that the statement text does
+    not vary with the number of values.
+    """
+    __slots__ = ('sqlstr', 'parts', 'names')
+
+    def __init__(self, sqlstr):
+        self.sqlstr = sqlstr
+        self.parts = tuple(
+            (text, compile_expr(field_name) if field_name else None,
+             _check_spec(spec, field_name) if field_name else None)
+            for text, field_name, spec, _ in _formatter.parse(sqlstr)
+        )
+        self.names = frozenset().union(
+            *(expr.names for _, expr, _ in self.parts if expr is not None))
+
+    def __repr__(self):
+        return f"SQLTemplate({self.sqlstr!r})"
+
+
+_SPECS = frozenset(['any'])
+
+
+def _check_spec(spec, field_name):
+    if not spec:
+        return None
+
+    if spec not in _SPECS:
+        raise ValueError(f"Unknown format spec '{spec}' of the placeholder "
+                         f"'{{{field_name}:{spec}}}', expected one of "
+                         f"{sorted(_SPECS)}")
+    return spec
+
+
+TEMPLATE_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(sqlstr):
+    """Parse the SQL format string once and cache its layout.
+
+    The hits and misses of the cache are reported by
+    ``compile_template.cache_info()``.
+    """
+    return SQLTemplate(sqlstr)
+
+
+def _sqlstr_parse(sqlstr, vars, share=False):
+    template = compile_template(sqlstr)
+
+    # snapshot only the variables referenced by the template
+    vars = {name: vars[name] for name in template.names if name in vars}
+
     segments = []
-    for text, field_name, _, _ in _formatter.parse(sqlstr):
-        segments.append(SQLSegment(text, vars))
+    for text, expr, spec in template.parts:
+        segments.append(text)
+
+        if expr is None:
+            continue
+
+        if expr._name is not None and expr._name not in vars:
+            val = _UNBOUND
+        else:
+            try:
+                val = expr.evaluate(vars)
+            except NameError:
+                val = _UNBOUND
+
+        if isinstance(val, SQLText):
+            segments += val._segments
+        else:
+            segments.append(SQLPlaceholder(expr, val,
+                                           _placeholder_vars(expr, vars),
+                                           spec, share))
+
+    return segments
+
+
+def _placeholder_vars(expr, vars):
+    """ the variables kept to evaluate the expression again with params """
+    if expr._name is not None:
+        # the name is either overridden by params or its value is bound
+        return _NO_VARS
 
-        if not field_name:
+    return {name: vars[name] for name in expr.names if name in vars}
+
+
+def is_template(obj):
+    """ whether it is a template string, as t"...", of PEP 750 """
+    return Template is not None and isinstance(obj, Template)
+
+
+_CONVERTERS = {'r': repr, 's': str, 'a': ascii}
+
+
+class TemplateExpr:
+    """The expression of an interpolation in a template string, its value is
+    bound by the compiler and never evaluated again.
+    """
+    __slots__ = ('expr',)
+
+    names = frozenset()
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def __repr__(self):
+        return f"TemplateExpr({self.expr!r})"
+
+
+def _template_parse(template, share=False):
+    segments = []
+    for item in template:
+        if isinstance(item, str):
+            segments.append(item)
             continue
-        
-        val = eval_expr(field_name, vars)
+
+        val = item.value
+        if item.conversion is not None:
+            val = _CONVERTERS[item.conversion](val)
 
         if isinstance(val, SQLText):
             segments += val._segments
+        elif is_template(val):
+            segments += _template_parse(val, share)
         else:
-            seg = SQLPlaceholder(field_name, val, vars)
-            segments.append(seg)
+            segments.append(SQLPlaceholder(
+                TemplateExpr(item.expression), val, _NO_VARS,
+                _check_spec(item.format_spec, item.expression), share))
 
     return segments
 
+
+class SQLExpr:
+    """The expression of a placeholder, compiled once.
+
+    A plain identifier like ``{sn}`` or an attribute chain like ``{user.id}``
+    is looked up directly in the variables, any other expression is evaluated
+    from its compiled code object.
+    """
+    __slots__ = ('expr', 'names', '_code', '_name', '_getattr')
+
+    def __init__(self, expr):
+        self.expr = expr
+        self._code = compile(expr.lstrip(' \t'), '<sql>', 'eval')
+
+        path = expr.strip().split('.')
+        if all(p.isidentifier() and not iskeyword(p) for p in path):
+            self._name = path[0]
+            self._getattr = attrgetter('.'.join(path[1:])) \
+                if len(path) > 1 else None
+            self.names = frozenset([self._name])
+        else:
+            self._name = None
+            self._getattr = None
+            self.names = frozenset(_code_names(self._code))
+
+    def evaluate(self, localvars):
+        try:
+            if self._name is not None and self._name in localvars:
+                value = localvars[self._name]
+                if self._getattr is not None:
+                    value = self._getattr(value)
+                return value
+
+            return eval(self._code, None, localvars)
+        except Exception as exc:
+            errmsg = (f"{str(exc)}, while evaluating the expression "
+                      f"'{self.expr}' with local variables: {localvars}")
+            raise type(exc)(errmsg)
+
+    def __repr__(self):
+        return f"SQLExpr({self.expr!r})"
+
+
+def _code_names(code):
+    """ collect the names referenced by the code and its nested code """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names |= _code_names(const)
+    return names
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_expr(expr):
+    return SQLExpr(expr)
+
+
 def eval_expr(expr, localvars):
-    try:
-        return eval(expr, None, localvars)
-    except Exception as exc:
-        errmsg = (f"{str(exc)}, while evaluating the expression " 
-                f"'{expr}' with local variables: {localvars}")
-        raise type(exc)(errmsg)
+    return compile_expr(expr).evaluate(localvars)
+
+
+def SQL(*sqlstrs, sep='', vars=None, share=False):
+    """Make the SQL text of the format strings joined by *sep*.
+
+    The placeholders are evaluated with the variables of *vars*, or with the
+    local variables of the caller if *vars* is None. The ones left unbound
+    are given by the params at execution.
 
-def SQL(*sqlstrs, sep='', vars=None):
+    A template string, as t"...", has its values bound already and is used
+    without being parsed or evaluated.
 
-    if vars is None:
+    With *share*, the repeated placeholders of the same name or attribute
+    chain bound with the same value are sent once as one parameter. The
+    server infers its type from the first occurrence, so only share the
+    values used in the contexts of the same type.
+    """
+    if vars is None and not all(is_template(s) for s in sqlstrs):
         vars = sys._getframe(1).f_locals
 
     sqltext = SQLText()
-    sqltext._join(*sqlstrs, sep=sep, vars=vars)
+    sqltext._join(*sqlstrs, sep=sep, vars=vars, share=share)
 
     return sqltext
 
@@ -1,3 +1,4 @@
 
 from .json import json_object_equals, json_dumps, json_loads
+from .json import JSONCodec, get_json_codec
 
@@ -1,29 +1,143 @@
+
 from datetime import datetime, date
 import json
-from dataclasses import is_dataclass, asdict
+from dataclasses import is_dataclass, fields
 from decimal import Decimal
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(o):
+    if is_dataclass(o):
+        # shallow, the nested values are encoded in turn by the encoder
+        return {f.name: getattr(o, f.name) for f in fields(o)}
+
+    if isinstance(o, (date, datetime)):
+        return o.isoformat()
+
+    if isinstance(o, Decimal):
+        return str(o)
+
+    if isinstance(o, complex):
+        return [o.real, o.imag]
+
+    raise TypeError(f"Object of type {type(o).__name__} "
+                    f"is not JSON serializable")
+
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
-        if is_dataclass(o):
-            return asdict(o)
+        try:
+            return _default(o)
+        except TypeError:
+            return json.JSONEncoder.default(self, o)
+
+
+class JSONCodec:
+    """The JSON serializer of the json and jsonb values.
+
+    :param dumps: The function encoding an object into a JSON string.
+    :param loads: The function decoding a JSON string into an object.
+    :param dumpb: The function encoding an object into UTF-8 bytes.
+    :param loadb: The function decoding an object from a bytes-like object,
+        like the memoryview of the binary jsonb value.
+    """
+    __slots__ = ('name', 'dumps', 'loads', 'dumpb', 'loadb')
+
+    def __init__(self, name, dumps, loads, dumpb=None, loadb=None):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+        if dumpb is None:
+            def dumpb(obj):
+                return dumps(obj).encode()
+        self.dumpb = dumpb
+
+        if loadb is None:
+            def loadb(data):
+                return loads(bytes(data))
+        self.loadb = loadb
+
+    def jsonb_encoder(self):
+        """The encoder of the jsonb value in binary format."""
+        dumpb = self.dumpb
+
+        def encode_jsonb(obj):
+            return JSONB_VERSION + dumpb(obj)
+
+        return encode_jsonb
+
+    def jsonb_decoder(self):
+        """The decoder of the jsonb value in binary format, which decodes the
+        document after the version byte without copying it.
+        """
+        loadb = self.loadb
 
-        if isinstance(o, (date, datetime)):
-            return o.isoformat()
+        def decode_jsonb(data):
+            if data[0] != 1:
+                raise ValueError(f"Unsupported jsonb version: {data[0]}")
+            return loadb(memoryview(data)[1:])
 
-        if isinstance(o, Decimal):
-            return str(o)
+        return decode_jsonb
 
-        if isinstance(o, complex):
-            return [o.real, o.imag]
+    def __repr__(self):
+        return f"JSONCodec({self.name!r})"
+
+
+JSONB_VERSION = b'\x01'  # the version byte of jsonb in binary format
+
+_stdlib_encoder = JSONEncoder()
+
+stdlib_json_codec = JSONCodec('json', _stdlib_encoder.encode, json.loads)
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def _orjson_dumpb(obj):
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+    def _orjson_dumps(obj):
+        return _orjson_dumpb(obj).decode()
+
+    orjson_codec = JSONCodec('orjson', _orjson_dumps, orjson.loads,
+                             dumpb=_orjson_dumpb, loadb=orjson.loads)
+else:
+    orjson_codec = None
+
+
+def get_json_codec(name=None):
+    """Get the JSON codec by name, or the fastest installed one if None.
+
+    :param name: 'orjson' or 'json'
+    """
+    if name is None:
+        return orjson_codec or stdlib_json_codec
+
+    if name == 'orjson':
+        if orjson_codec is None:
+            raise ValueError("The JSON backend 'orjson' is not installed")
+        return orjson_codec
+
+    if name == 'json':
+        return stdlib_json_codec
+
+    raise ValueError(f"Unknown JSON backend: '{name}'")
+
+
+_default_codec = get_json_codec()
 
-        return json.JSONEncoder.default(self, o)
 
 def json_loads(s):
-    return json.loads(s)
+    return _default_codec.loads(s)
+
 
 def json_dumps(obj):
-    return json.dumps(obj, cls=JSONEncoder)
+    return _default_codec.dumps(obj)
+
 
 def json_object_equals(json_a, json_b):
     if type(json_a) != type(json_b):
@@ -1,9 +1,16 @@
 
 import asyncio
+import io
+from dataclasses import dataclass
+from decimal import Decimal
 
 from sqlblock.sqltext import SQL
 from sqlblock.postgres.connection import AsyncPostgresSQL
+from sqlblock.postgres._sqlblock import Record
+from sqlblock.postgres.instrument import StatementInstrument
+from sqlblock.postgres.resultcache import ResultCache
 
+import asyncpg
 import pytest
 
 
@@ -128,6 +135,671 @@ async def test_sql_command(conn):
     await block_func()
 
 
+@pytest.mark.asyncio
+async def test_record_type(conn):
+
+    @conn.transaction
+    async def func():
+        SQL("SELECT 1::INTEGER AS a, 'x'::TEXT AS b") >> conn
+        r1 = await conn.first()
+
+        SQL("SELECT 2::INTEGER AS a, 'y'::TEXT AS b") >> conn
+        r2 = [r async for r in conn][0]
+
+        assert type(r1) is type(r2)
+        assert not hasattr(r1, '__dict__')
+        assert (r1.a, r1.b, r2.a, r2.b) == (1, 'x', 2, 'y')
+
+        SQL("SELECT 1::BIGINT AS a, 'x'::TEXT AS b") >> conn
+        assert type(await conn.first()) is not type(r1)
+
+    await func()
+
+
+@pytest.mark.asyncio
+async def test_raw_rows(conn):
+
+    @conn.transaction(raw=True)
+    async def func1():
+        SQL("SELECT sn FROM generate_series(1, 3) AS t(sn)") >> conn
+        rows = [r async for r in conn]
+        assert [r.sn for r in rows] == [1, 2, 3]
+        assert [r['sn'] for r in rows] == [1, 2, 3]
+        assert [tuple(r) for r in rows] == [(1,), (2,), (3,)]
+
+    @conn.transaction
+    async def func2():
+        SQL("SELECT 1 AS sn") >> conn
+        assert isinstance(await conn.raw().first(), Record)
+
+        SQL("SELECT 1 AS sn") >> conn
+        assert not isinstance(await conn.first(), Record)
+
+    await func1()
+    await func2()
+
+
+@pytest.mark.asyncio
+async def test_executemany(conn):
+
+    @conn.transaction
+    async def func():
+        SQL("CREATE TEMPORARY TABLE test_many (a INTEGER, b TEXT)") >> conn
+        await conn
+
+        SQL("INSERT INTO test_many (a, b) VALUES ({a}, {b})") >> conn
+        many_params = (dict(a=i, b=str(i)) for i in range(5))
+        assert await conn.executemany(many_params, chunk_size=2) == 5
+
+        SQL("SELECT a, b FROM test_many ORDER BY a") >> conn
+        assert [(r.a, r.b) async for r in conn] == [
+            (i, str(i)) for i in range(5)]
+
+    await func()
+
+
+@pytest.mark.asyncio
+async def test_copy(conn):
+
+    async def records():
+        for i in range(3):
+            yield (i, str(i))
+
+    @conn.transaction
+    async def func():
+        SQL("CREATE TEMPORARY TABLE test_copy (a INTEGER, b TEXT)") >> conn
+        await conn
+
+        await conn.copy_records_to_table('test_copy', records=records())
+        await conn.copy_to_table('test_copy', source=io.BytesIO(b'3\t3\n'))
+
+        start = 1
+        SQL("SELECT a, b FROM test_copy WHERE a >= {start} ORDER BY a") >> conn
+        output = io.BytesIO()
+        await conn.copy_from_query(output, format='csv')
+        assert output.getvalue() == b'1,1\n2,2\n3,3\n'
+
+    await func()
+
+
+@pytest.mark.asyncio
+async def test_batches(conn):
+
+    @conn.transaction
+    async def func():
+        SQL("SELECT sn FROM generate_series(1, {n}) AS t(sn)") >> conn
+        batches = [[r.sn for r in rows] async for rows in conn.batches(n=5, size=2)]
+        assert batches == [[1, 2], [3, 4], [5]]
+
+        SQL("SELECT sn FROM generate_series(1, 4) AS t(sn)") >> conn
+        batches = [len(rows) async for rows in conn.raw().batches(size=2)]
+        assert batches == [2, 2]
+
+        SQL("SELECT sn FROM generate_series(1, 5) AS t(sn)") >> conn
+        assert [r.sn async for r in conn.prefetch(2)] == [1, 2, 3, 4, 5]
+
+    @conn.transaction(autocommit=True)
+    async def func_autocommit():
+        SQL("SELECT sn FROM generate_series(1, 3) AS t(sn)") >> conn
+        batches = [[r.sn for r in rows] async for rows in conn.batches(size=2)]
+        assert batches == [[1, 2], [3]]
+
+    await func()
+    await func_autocommit()
+
+
+@pytest.mark.asyncio
+async def test_statement_cache(conn):
+
+    @conn.transaction
+    async def func(sn):
+        SQL("SELECT {sn}::INTEGER AS sn") >> conn
+        return (await conn.first()).sn
+
+    info = conn.statement_cache_info()
+    assert await func(1) == 1
+    assert await func(2) == 2
+    assert await func(3) == 3
+    assert conn.statement_cache_info()['hits'] - info['hits'] >= 2
+
+    @conn.transaction(autocommit=True)
+    async def change_schema():
+        SQL("CREATE TABLE IF NOT EXISTS test_stale (a INTEGER)") >> conn
+        await conn
+
+        SQL("SELECT * FROM test_stale") >> conn
+        assert [r async for r in conn] == []
+
+        SQL("ALTER TABLE test_stale ADD COLUMN b INTEGER") >> conn
+        await conn
+
+        SQL("SELECT * FROM test_stale") >> conn
+        assert [r async for r in conn] == []
+
+        SQL("DROP TABLE test_stale") >> conn
+        await conn
+
+    info = conn.statement_cache_info()
+    await change_schema()
+    assert conn.statement_cache_info()['invalidations'] > info['invalidations']
+
+
+@pytest.mark.asyncio
+async def test_fetch_val(conn):
+
+    @conn.transaction
+    async def func():
+        SQL("SELECT 1 AS a, 'x' AS b") >> conn
+        assert await conn.fetch_val() == 1
+        assert await conn.fetch_val('b') == 'x'
+
+        SQL("SELECT {sn}::INTEGER AS sn WHERE {sn} > 0") >> conn
+        assert await conn.fetch_val(sn=0) is None
+        assert (await conn.fetch_one(sn=1)).sn == 1
+
+    await func()
+
+
+@pytest.mark.asyncio
+async def test_pipeline(conn):
+
+    @conn.transaction
+    async def func():
+        n = 3
+        pipe = conn.pipeline()
+        SQL("SELECT sn, sn * 10 AS v FROM generate_series(1, {n}) AS t(sn)") >> pipe
+        SQL("SELECT {n}::INTEGER AS n, 'x'::TEXT AS s") >> pipe
+        pipe << SQL("SELECT 1 AS a WHERE false")
+        r1, r2, r3 = await pipe
+
+        assert [(r.sn, r.v) for r in r1] == [(1, 10), (2, 20), (3, 30)]
+        assert (r2[0].n, r2[0].s) == (3, 'x')
+        assert r3 == []
+
+        # a jsonb column decoded by a text codec falls back to one by one
+        pipe = conn.pipeline()
+        SQL("SELECT '{{\"a\": 1}}'::jsonb AS j") >> pipe
+        SQL("SELECT 2 AS b") >> pipe
+        r1, r2 = await pipe
+        assert r1[0].j == {'a': 1} and r2[0].b == 2
+
+    await func()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_modes():
+    dsn = "postgresql://postgres@localhost/sqlblock_test"
+
+    def make_func(conn, raw=False):
+        @conn.transaction(raw=raw)
+        async def func():
+            pipe = conn.pipeline()
+            SQL("SELECT sn FROM generate_series(1, 2) AS t(sn)") >> pipe
+            SQL("SELECT '{{\"a\": 1}}'::jsonb AS j") >> pipe
+            r1, r2 = await pipe
+            assert [r.sn for r in r1] == [1, 2]
+            if raw:
+                assert [r['sn'] for r in r1] == [r[0] for r in r1] == [1, 2]
+            assert r2[0].j == {'a': 1}
+            return conn._sqlblock._stmt_cache
+        return func
+
+    # rows with the column names in raw mode
+    conn = AsyncPostgresSQL(dsn=dsn, json_format='binary')
+    async with conn:
+        cache = await make_func(conn, raw=True)()
+        assert not cache.sequential_pipelines
+
+    # the sequential pipelines are remembered per statement cache
+    conn = AsyncPostgresSQL(dsn=dsn)
+    async with conn:
+        cache = await make_func(conn)()
+        assert len(cache.sequential_pipelines) == 1
+
+    # no statements prepared in advance without the statement cache
+    events = []
+    conn = AsyncPostgresSQL(dsn=dsn, json_format='binary',
+                            statement_cache_size=0,
+                            instrument=StatementInstrument(events.append))
+    async with conn:
+        assert await make_func(conn)() is None
+    assert len(events) == 2
+
+
+@pytest.mark.asyncio
+async def test_json_codec(conn):
+
+    @dataclass
+    class Item:
+        sn: int
+        price: Decimal
+
+    @conn.transaction
+    async def func():
+        doc = {'items': [Item(1, Decimal('2.5'))]}
+        SQL("SELECT {doc}::jsonb AS b, {doc}::json AS j") >> conn
+        r = await conn.first()
+        assert r.b == r.j == {'items': [{'sn': 1, 'price': '2.5'}]}
+
+    await func()
+
+
+@pytest.mark.asyncio
+async def test_json_binary_format():
+    conn = AsyncPostgresSQL(dsn="postgresql://postgres@localhost/sqlblock_test",
+                            json_format='binary')
+
+    @conn.transaction
+    async def func():
+        doc = {'a': [1, 'x'], 'b': None}
+        SQL("SELECT {doc}::jsonb AS b, {doc}::json AS j") >> conn
+        r = await conn.first()
+        assert r.b == r.j == doc
+
+        pipe = conn.pipeline()
+        SQL("SELECT {doc}::jsonb AS b") >> pipe
+        SQL("SELECT 1 AS n") >> pipe
+        r1, r2 = await pipe
+        assert r1[0].b == doc and r2[0].n == 1
+
+    async with conn:
+        await func()
+
+
+@pytest.mark.asyncio
+async def test_pool_stats(conn):
+
+    @conn.transaction
+    async def func():
+        stats = conn.stats()
+        assert stats['in_use'] >= 1 and stats['waiting'] == 0
+        SQL("SELECT 1 AS sn") >> conn
+        await conn.first()
+
+    acquired = conn.stats()['acquired']
+    await asyncio.gather(func(), func())
+
+    stats = conn.stats()
+    assert stats['acquired'] == acquired + 2
+    assert stats['in_use'] == 0 and stats['idle'] == stats['size']
+    assert stats['hold_time']['count'] >= 2
+    assert sum(stats['acquire_time']['buckets'].values()) == \
+        stats['acquire_time']['count']
+    assert 'hits' in stats['statement_cache']
+
+
+@pytest.mark.asyncio
+async def test_stats_callback():
+    reports = []
+    conn = AsyncPostgresSQL(dsn="postgresql://postgres@localhost/sqlblock_test",
+                            stats_callback=reports.append, stats_interval=0.01)
+    async with conn:
+        await asyncio.sleep(0.05)
+
+    assert reports and 'acquire_time' in reports[0]
+
+
+@pytest.mark.asyncio
+async def test_instrument():
+    events = []
+    instrument = StatementInstrument(events.append, slow_threshold=10.0)
+    conn = AsyncPostgresSQL(dsn="postgresql://postgres@localhost/sqlblock_test",
+                            instrument=instrument)
+
+    @conn.transaction
+    async def func():
+        SQL("SELECT sn FROM generate_series(1, 3) AS t(sn)") >> conn
+        await conn.fetch_one()
+
+        SQL("SELECT sn FROM generate_series(1, 3) AS t(sn)") >> conn
+        assert len([r async for r in conn]) == 3
+
+    async with conn:
+        await func()
+
+    assert [e.rows for e in events] == [1, None]
+    assert events[0].template_id == events[1].template_id
+    assert events[0].func.endswith('test_instrument.<locals>.func')
+    assert all(e.execute_time >= 0 and not e.slow for e in events)
+
+    events.clear()
+    instrument.slow_threshold = 0
+    instrument.sample_rate = 0
+    async with conn:
+        await func()
+    assert len(events) == 2 and all(e.slow for e in events)
+
+
+@pytest.mark.asyncio
+async def test_instrument_unexecuted():
+    events = []
+    conn = AsyncPostgresSQL(dsn="postgresql://postgres@localhost/sqlblock_test",
+                            instrument=StatementInstrument(events.append),
+                            result_cache=ResultCache())
+
+    @conn.transaction(autocommit=True)
+    async def func():
+        SQL("SELECT 1 AS sn") >> conn
+        await conn.fetch_cached()
+        SQL("SELECT 1 AS sn") >> conn
+        await conn.fetch_cached()  # a hit not executed
+        assert conn._sqlblock._render_time == 0.0
+
+        SQL("SELECT 1 AS sn") >> conn
+        await conn.copy_from_query(io.BytesIO())
+        assert conn._sqlblock._render_time == 0.0
+
+    async with conn:
+        await func()
+    assert len(events) == 1
+
+
+@pytest.mark.asyncio
+async def test_result_cache():
+    dsn = "postgresql://postgres@localhost/sqlblock_test"
+    conn1 = AsyncPostgresSQL(dsn=dsn, result_cache=ResultCache(
+        ttl=60, channel='sqlblock_test_cache'))
+    conn2 = AsyncPostgresSQL(dsn=dsn, result_cache=ResultCache(
+        ttl=60, channel='sqlblock_test_cache'))
+
+    def make_lookup(conn):
+        @conn.transaction
+        async def lookup(sn):
+            SQL("SELECT {sn}::INTEGER AS sn, random() AS r") >> conn
+            return await conn.fetch_cached(tags=['numbers'])
+        return lookup
+
+    @conn1.transaction
+    async def invalidate():
+        await conn1.invalidate_cache('numbers')
+
+    lookup1, lookup2 = make_lookup(conn1), make_lookup(conn2)
+
+    async with conn1, conn2:
+        rows = await lookup1(1)
+        assert rows[0].sn == 1
+        assert await lookup1(1) == rows
+        assert await lookup1(2) != rows
+        assert conn1.result_cache.info()['hits'] == 1
+
+        rows2 = await lookup2(1)
+        await asyncio.sleep(0.1)  # let the listener start
+        await invalidate()
+        assert await lookup1(1) != rows
+
+        for _ in range(50):
+            if not len(conn2.result_cache):
+                break
+            await asyncio.sleep(0.02)
+        assert await lookup2(1) != rows2
+
+    cache = ResultCache(ttl=0)
+    cache.put('k', [1])
+    assert cache.get('k') is None
+
+
+@pytest.mark.asyncio
+async def test_subscribe(conn):
+
+    @conn.transaction(autocommit=True)
+    async def notify(payload):
+        SQL("SELECT pg_notify('sqlblock_test_sub', {payload})") >> conn
+        await conn.execute()
+
+    sub1 = await conn.subscribe('sqlblock_test_sub')
+    sub2 = await conn.subscribe('sqlblock_test_sub', maxsize=2)
+    sub3 = await conn.subscribe('sqlblock_test_sub', policy='coalesce')
+
+    for payload in ['a', 'b', 'a', 'c']:
+        await notify(payload)
+    await asyncio.sleep(0.1)
+
+    assert [await sub1.get() for _ in range(4)] == ['a', 'b', 'a', 'c']
+    assert [await sub2.get() for _ in range(2)] == ['a', 'c']
+    assert sub2.dropped == 2
+    assert [await sub3.get() for _ in range(3)] == ['a', 'b', 'c']
+    assert sub3.dropped == 1
+
+    stats = conn.stats()['listener']
+    assert len(stats['channels']['sqlblock_test_sub']) == 3
+
+    async def consume():
+        return [payload async for payload in sub1]
+
+    task = asyncio.ensure_future(consume())
+    await notify('d')
+    await asyncio.sleep(0.1)
+    await sub1.close()
+    assert await task == ['d']
+    assert sub1.max_lag >= 0
+
+    # reconnect after the connection of listener is terminated
+    listener = conn._listener
+    listener._reconnect_delay = 0.01
+    pid = listener._conn.get_server_pid()
+
+    @conn.transaction(autocommit=True)
+    async def terminate(pid):
+        SQL("SELECT pg_terminate_backend({pid})") >> conn
+        await conn.execute()
+
+    await terminate(pid)
+    for _ in range(100):
+        if listener.reconnects:
+            break
+        await asyncio.sleep(0.02)
+    assert listener.reconnects == 1
+
+    await notify('e')
+    assert await sub3.get() == 'd'
+    assert await asyncio.wait_for(sub3.get(), 2) == 'e'
+
+    with pytest.raises(ValueError):
+        await conn.subscribe('sqlblock_test_sub', policy='unknown')
+
+
+@pytest.mark.asyncio
+async def test_notify_many(conn):
+
+    @conn.transaction
+    async def publish(events):
+        await conn.notify('sqlblock_test_pub', 'hello')
+        return await conn.notify_many(
+            ('sqlblock_test_pub', event) for event in events)
+
+    sub = await conn.subscribe('sqlblock_test_pub', maxsize=2000)
+    events = [{'sn': i} for i in range(1000)]
+    assert await publish(events) == 1000
+    assert await publish([]) == 0
+
+    assert await sub.get() == 'hello'
+    payloads = [await asyncio.wait_for(sub.get(), 2) for _ in events]
+    assert [conn.json_codec.loads(p) for p in payloads] == events
+    assert await sub.get() == 'hello'
+    await sub.close()
+
+
+@pytest.mark.asyncio
+async def test_nesting():
+    conn = AsyncPostgresSQL(dsn="postgresql://postgres@localhost/sqlblock_test",
+                            nesting='join')
+
+    @conn.transaction
+    async def outer(isolated):
+        SQL("CREATE TEMP TABLE t_nesting (sn INTEGER) ON COMMIT DROP") >> conn
+        await conn.execute()
+
+        try:
+            await (inner_isolated() if isolated else inner())
+        except KeyError:
+            pass
+
+        SQL("SELECT count(*) FROM t_nesting") >> conn
+        return await conn.fetch_val()
+
+    async def insert():
+        SQL("INSERT INTO t_nesting VALUES (1)") >> conn
+        await conn.execute()
+        raise KeyError()
+
+    inner = conn.transaction(insert)
+    inner_isolated = conn.transaction(nesting='savepoint')(insert)
+
+    async with conn:
+        assert await outer(False) == 1  # joined the outer transaction
+        assert await outer(True) == 0  # rolled back to the savepoint
+
+    with pytest.raises(ValueError):
+        conn.transaction(nesting='unknown')
+
+
+@pytest.mark.asyncio
+async def test_readonly_replicas():
+    dsn = "postgresql://postgres@localhost/sqlblock_test"
+    conn = AsyncPostgresSQL(dsn=dsn, min_size=1, max_size=2,
+                            replicas=[dsn, dsn])
+
+    @conn.transaction(readonly=True)
+    async def read():
+        SQL("SHOW transaction_read_only") >> conn
+        return await conn.fetch_val()
+
+    @conn.transaction(readonly=True)
+    async def write():
+        SQL("CREATE TEMP TABLE t_readonly (sn INTEGER)") >> conn
+        await conn.execute()
+
+    @conn.transaction
+    async def read_write():
+        SQL("SHOW transaction_read_only") >> conn
+        return await conn.fetch_val()
+
+    async with conn:
+        assert await read() == 'on'
+        assert await read_write() == 'off'
+        assert await asyncio.gather(read(), read()) == ['on', 'on']
+
+        with pytest.raises(asyncpg.exceptions.ReadOnlySQLTransactionError):
+            await write()
+
+        stats = conn.stats()
+        assert stats['acquired'] == 1
+        # the concurrent one goes to the less loaded replica
+        assert [r['acquired'] for r in stats['replicas']] == [3, 1]
+
+
+@pytest.mark.asyncio
+async def test_bind(conn):
+
+    @conn.transaction
+    async def func():
+        sn = 'local'
+        conn.bind("SELECT {sn}::INTEGER AS sn, {no}::INTEGER AS no", sn=1)
+        r = await conn.fetch_first(no=2)
+        assert (r.sn, r.no) == (1, 2)
+
+    await func()
+
+
+@pytest.mark.asyncio
+async def test_any_spec(conn):
+
+    @conn.transaction
+    async def func(ids):
+        SQL("SELECT sn FROM generate_series(1, 10) AS t(sn) "
+            "WHERE sn {ids:any} ORDER BY sn") >> conn
+        return [r.sn async for r in conn]
+
+    assert await func([3, 5]) == [3, 5]
+    assert await func((2, 4, 6)) == [2, 4, 6]
+    assert await func([]) == []
+
+
+@pytest.mark.asyncio
+async def test_shared_params(conn):
+
+    @conn.transaction
+    async def func(share):
+        n = 3
+        conn << SQL("SELECT 1.5 < {n} AS a, {n} / 2 AS half", share=share)
+        return await conn.fetch_first()
+
+    # each occurrence has the type inferred from its own context
+    r = await func(False)
+    assert r.a is True and r.half == 1
+
+    # the shared one has the type inferred from the first occurrence
+    r = await func(True)
+    assert r.a is True and r.half == Decimal('1.5')
+
+
+@pytest.mark.asyncio
+async def test_unreachable_replica():
+    conn = AsyncPostgresSQL(
+        dsn="postgresql://postgres@localhost/sqlblock_test",
+        min_size=1, max_size=1,
+        replicas=["postgresql://postgres@localhost:1/sqlblock_test"])
+
+    @conn.transaction(readonly=True)
+    async def read():
+        SQL("SHOW transaction_read_only") >> conn
+        return await conn.fetch_val()
+
+    async with conn:
+        assert await read() == 'on'  # on the primary
+        assert await read() == 'on'
+        assert conn.stats()['acquired'] == 2
+
+
+@pytest.mark.asyncio
+async def test_result_cache_consistency():
+    dsn = "postgresql://postgres@localhost/sqlblock_test"
+    conn1 = AsyncPostgresSQL(dsn=dsn, result_cache=ResultCache(
+        ttl=60, channel='sqlblock_test_cache2'))
+    conn2 = AsyncPostgresSQL(dsn=dsn, result_cache=ResultCache(
+        ttl=60, channel='sqlblock_test_cache2'))
+
+    @conn1.transaction
+    async def lookup(sn):
+        SQL("SELECT {sn}::INTEGER AS sn") >> conn1
+        return await conn1.fetch_cached(tags=['a,b'])
+
+    @conn1.transaction
+    async def lookup_rolled_back(sn):
+        await lookup(sn)
+        raise KeyError()
+
+    @conn2.transaction
+    async def lookup2(sn):
+        SQL("SELECT {sn}::INTEGER AS sn, random() AS r") >> conn2
+        return await conn2.fetch_cached(tags=['a,b'])
+
+    @conn1.transaction
+    async def invalidate():
+        await conn1.invalidate_cache('a,b')
+
+    async with conn1, conn2:
+        # the cached rows are not shared with the callers
+        rows = await lookup(1)
+        rows[0].sn = 100
+        assert (await lookup(1))[0].sn == 1
+
+        # nothing is cached by a transaction rolled back
+        with pytest.raises(KeyError):
+            await lookup_rolled_back(2)
+        assert len(conn1.result_cache) == 1
+
+        # the tag with a comma is invalidated in the other instance
+        rows2 = await lookup2(1)
+        await asyncio.sleep(0.1)  # let the listener start
+        await invalidate()
+        for _ in range(50):
+            if not len(conn2.result_cache):
+                break
+            await asyncio.sleep(0.02)
+        assert await lookup2(1) != rows2
+
+
 @pytest.mark.asyncio
 async def test_transaction(conn):
 
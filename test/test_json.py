@@ -0,0 +1,72 @@
+import pytest
+
+from dataclasses import dataclass
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlblock.utils import get_json_codec, json_dumps, json_loads
+from sqlblock.utils.json import orjson_codec
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+@dataclass
+class Shape:
+    name: str
+    points: list
+    created: date
+
+
+codecs = [get_json_codec('json')]
+if orjson_codec is not None:
+    codecs.append(orjson_codec)
+
+
+@pytest.mark.parametrize('codec', codecs, ids=lambda c: c.name)
+def test_json_codec(codec):
+    shape = Shape('line', [Point(0, 0), Point(1, 2)], date(2020, 1, 2))
+
+    obj = codec.loads(codec.dumps({
+        'shape': shape,
+        'price': Decimal('1.10'),
+        'at': datetime(2020, 1, 2, 3, 4, 5),
+        'z': 1 + 2j,
+    }))
+
+    assert obj == {
+        'shape': {
+            'name': 'line',
+            'points': [{'x': 0, 'y': 0}, {'x': 1, 'y': 2}],
+            'created': '2020-01-02',
+        },
+        'price': '1.10',
+        'at': '2020-01-02T03:04:05',
+        'z': [1.0, 2.0],
+    }
+
+    with pytest.raises(TypeError):
+        codec.dumps(object())
+
+
+@pytest.mark.parametrize('codec', codecs, ids=lambda c: c.name)
+def test_jsonb_binary(codec):
+    encode, decode = codec.jsonb_encoder(), codec.jsonb_decoder()
+
+    data = encode({'a': [1, Point(2, 3)]})
+    assert data[:1] == b'\x01'
+    assert decode(data) == {'a': [1, {'x': 2, 'y': 3}]}
+    assert codec.loadb(memoryview(codec.dumpb([1, 'b']))) == [1, 'b']
+
+    with pytest.raises(ValueError):
+        decode(b'\x02{}')
+
+
+def test_default_codec():
+    assert json_loads(json_dumps({'a': [1, 'b']})) == {'a': [1, 'b']}
+
+    with pytest.raises(ValueError):
+        get_json_codec('unknown')
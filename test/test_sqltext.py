@@ -1,6 +1,6 @@
 import pytest
 
-from sqlblock.sqltext import SQL
+from sqlblock.sqltext import SQL, compile_template, compile_expr
 
 
 def test_sqltext():
@@ -75,3 +75,173 @@ def test_fragments():
     stmt, vals = sql.get_statment()
 
     print(stmt, vals)
+
+
+def test_template_cache():
+    compile_template.cache_clear()
+
+    for sn in range(3):
+        stmt, vals = SQL("SELECT {sn} AS sn").get_statment()
+        assert stmt == 'SELECT $1 AS sn' and vals == [sn]
+
+    info = compile_template.cache_info()
+    assert info.misses == 1 and info.hits == 2
+
+    template = compile_template("a{b}\nc{d.e}f")
+    assert [text for text, _, _ in template.parts] == ['a', '\nc', 'f']
+    assert [expr and expr.expr for _, expr, _ in template.parts] == [
+        'b', 'd.e', None]
+
+
+def test_placeholder_expr():
+    class User:
+        id = 10
+
+    user, ids = User(), [3, 4]
+
+    stmt, vals = SQL("{user.id}{ user.id }{ids[1]}{len(ids)}").get_statment()
+    assert stmt == '$1$2$3$4' and vals == [10, 10, 4, 2]
+
+    assert compile_expr('user.id').names == {'user'}
+    assert compile_expr('ids[0] + n').names == {'ids', 'n'}
+
+    s = SQL("{ids[0] + n}{user.id}", vars=dict(ids=ids, n=1, user=user))
+    _, vals = s.get_statment(params=dict(n=100))
+    assert vals == [103, 10]
+
+    s = SQL("{undefined_name}")
+    assert s.get_statment(params=dict(undefined_name=1)) == ('$1', [1])
+    with pytest.raises(NameError):
+        s.get_statment()
+
+
+def test_statement_cache():
+    a, b = 1, 2
+
+    s = SQL("{a}")
+    s2 = s + SQL(",{b}")
+    assert s2.get_statment() == ('$1,$2', [1, 2])
+    assert s.get_statment() == ('$1', [1])
+
+    stmt1, _ = s.get_statment()
+    stmt2, _ = s.get_statment()
+    assert stmt1 is stmt2
+
+    s += SQL(",{b}")
+    assert s.get_statment() == ('$1,$2', [1, 2])
+
+    s = SQL("VALUES ")
+    for i in range(1000):
+        s += SQL("({i}),") if i < 999 else SQL("({i})")
+    stmt, vals = s.get_statment()
+    assert stmt.endswith('($999),($1000)') and vals == list(range(1000))
+
+
+def test_many_params():
+    b = 0
+    s = SQL("INSERT INTO t VALUES ({a}, {b})")
+    stmt, many_vals = s.get_statment(many_params=[dict(a=1), dict(a=2, b=3)])
+    assert stmt == 'INSERT INTO t VALUES ($1, $2);'
+    assert many_vals == [[1, 0], [2, 3]]
+
+
+def test_binding():
+    sn, unused = 1, object()
+    user = type('User', (), {'id': 7})()
+
+    s = SQL("SELECT {sn}, {user.id}, {len(names)}", vars=dict(
+        sn=sn, user=user, names=['a', 'b'], unused=unused))
+    assert s.get_statment() == ('SELECT $1, $2, $3', [1, 7, 2])
+    assert compile_template("{a + b} {c.d}").names == {'a', 'b', 'c'}
+
+    # only the referenced variables are captured
+    s = SQL("SELECT {sn}")
+    assert all('unused' not in seg.vars for seg in s._segments
+               if not isinstance(seg, str))
+
+    # explicit params without the variables of the caller
+    s = SQL("SELECT {sn}, {no}", vars={})
+    assert s.get_statment(params=dict(sn=2, no=3)) == ('SELECT $1, $2', [2, 3])
+    with pytest.raises(NameError):
+        s.get_statment()
+
+
+def test_compact_segments():
+    import gc
+    import weakref
+
+    class Big:
+        pass
+
+    def make():
+        big, a, b = Big(), 1, 2
+        return SQL("SELECT {a}, {a + b}"), weakref.ref(big)
+
+    s, ref = make()
+    assert s._segments[0] == 'SELECT '
+    assert s._segments[1].vars == {} and s._segments[3].vars == dict(a=1, b=2)
+
+    gc.collect()
+    assert ref() is None  # the unreferenced local is not retained
+    assert s.get_statment(params=dict(b=10)) == ('SELECT $1, $2', [1, 11])
+
+
+def test_template_string():
+    templatelib = pytest.importorskip("string.templatelib")
+    Template, Interpolation = templatelib.Template, templatelib.Interpolation
+
+    cond = Template(" AND name = ", Interpolation('abc', 'name'))
+    s = SQL(Template("SELECT * FROM t WHERE sn = ", Interpolation(1, 'sn'),
+                     Interpolation(cond, 'cond')))
+    assert s.get_statment() == (
+        'SELECT * FROM t WHERE sn = $1 AND name = $2', [1, 'abc'])
+
+    # the bound values are not overridden by params
+    assert s.get_statment(params=dict(sn=2))[1] == [1, 'abc']
+
+    s += Template(" OR sn = ", Interpolation(3, 'sn + 2'))
+    assert s.get_statment()[0].endswith('OR sn = $3')
+
+
+def test_any_spec():
+    ids = [1, 2, 3]
+    s = SQL("SELECT * FROM t WHERE sn {ids:any}")
+    assert s.get_statment() == ('SELECT * FROM t WHERE sn = ANY($1)', [ids])
+
+    stmt, vals = s.get_statment(params=dict(ids={4, 5}))
+    assert stmt == 'SELECT * FROM t WHERE sn = ANY($1)'
+    assert sorted(vals[0]) == [4, 5]
+
+    with pytest.raises(TypeError):
+        s.get_statment(params=dict(ids='abc'))
+
+    with pytest.raises(ValueError):
+        SQL("SELECT {ids:in}")
+
+
+def test_shared_placeholders():
+    tenant_id, ids = 7, [1, 2]
+
+    s = SQL("WITH a AS (SELECT * FROM t WHERE tenant_id = {tenant_id}) ",
+            share=True)
+    s += SQL("SELECT * FROM a, u WHERE u.tenant_id = {tenant_id} "
+             "AND u.sn {ids:any} AND u.no {ids:any} AND u.x = {tenant_id + 0}",
+             share=True)
+    stmt, vals = s.get_statment()
+    assert stmt.count('$1') == 2 and stmt.count('= ANY($2)') == 2
+    assert stmt.endswith('u.x = $3') and vals == [7, ids, 7]
+
+    assert s.get_statment(params=dict(tenant_id=8))[1] == [8, ids, 8]
+
+    def other_scope():
+        tenant_id = 9
+        return SQL(" AND v.tenant_id = {tenant_id}", share=True)
+
+    s += other_scope()
+    stmt, vals = s.get_statment()
+    assert stmt.endswith('v.tenant_id = $4') and vals == [7, ids, 7, 9]
+
+    # not shared by default
+    s += SQL(" AND w.tenant_id = {tenant_id}")
+    stmt, vals = s.get_statment()
+    assert stmt.endswith('w.tenant_id = $5') and vals == [7, ids, 7, 9, 7]